@@ -6,17 +6,23 @@
 #   r is a row,    e.g. 'A'
 #   c is a column, e.g. '3'
 #   s is a square, e.g. 'A3'
+#   i is a square index into squares, e.g. 2 for 'A3'
 #   d is a digit,  e.g. '9'
+#   b is a digit bit, e.g. 0b100000000 for '9'
 #   u is a unit,   e.g. ['A1','B1','C1','D1','E1','F1','G1','H1','I1']
 #   grid is a grid,e.g. 81 non-blank chars, e.g. starting with '.18...7...
-#   values is a dict of possible values, e.g. {'A1':'12349', 'A2':'8', ...}
+#   values is a list of 81 candidate masks, e.g. [0b100001111, 0b010000000, ...]
+import os
+import itertools
+import sys
 import time
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 
 def cross(front, back):
     """Cross product of elements in A and elements in B."""
-    return [a + b for a in front for b in back]
+    return [sys.intern(a + b) for a in front for b in back]
 
 
 digits = '123456789'
@@ -28,9 +34,21 @@ unit_list = ([cross(rows, c) for c in cols] +
              [cross(rs, cs) for rs in ('ABC', 'DEF', 'GHI') for cs in ('123', '456', '789')])
 units = dict((s, [u for u in unit_list if s in u])
              for s in squares)
-peers = dict((s, set(sum(units[s], [])) - {s})
+peers = dict((s, frozenset(itertools.chain.from_iterable(units[s])) - {s})
              for s in squares)
 
+# The solver works on a list of 81 candidate bitmasks indexed like squares:
+# bit k of values[i] is set when digits[k] is still possible in squares[i].
+SQ_IDX = dict((s, i) for i, s in enumerate(squares))
+UNITS = [tuple(tuple(SQ_IDX[s2] for s2 in u) for u in units[s]) for s in squares]
+PEERS = [tuple(sorted(SQ_IDX[s2] for s2 in peers[s])) for s in squares]
+ALL_DIGITS = 0x1FF
+DIGIT_MASK = dict((d, 1 << k) for k, d in enumerate(digits))
+GRID_CHAR_MASK = dict(DIGIT_MASK, **{'0': 0, '.': 0})
+POPCOUNT = bytes(bin(m).count('1') for m in range(512))
+MASK_BITS = [tuple(1 << k for k in range(9) if m >> k & 1) for m in range(512)]
+MASK_DIGITS = [''.join(d for k, d in enumerate(digits) if m >> k & 1) for m in range(512)]
+
 
 # Unit Tests #
 
@@ -45,22 +63,49 @@ def test():
                            ['A1', 'A2', 'A3', 'B1', 'B2', 'B3', 'C1', 'C2', 'C3']]
     assert peers['C2'] == {'A2', 'B2', 'D2', 'E2', 'F2', 'G2', 'H2', 'I2', 'C1', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8',
                            'C9', 'A1', 'A3', 'B1', 'B3'}
+    assert all(len(PEERS[i]) == 20 for i in range(81))
+    assert MASK_DIGITS[DIGIT_MASK['3'] | DIGIT_MASK['7']] == '37'
+    assert POPCOUNT[ALL_DIGITS] == 9
+    assert grid_masks(grid2)[:2] == [DIGIT_MASK['4'], 0]
+    # Naked pair: A1 and A2 both hold only 1 and 2, so the rest of row A and of their cube lose 1 and 2
+    pair = DIGIT_MASK['1'] | DIGIT_MASK['2']
+    row_a, cube_a = UNITS[0][1], UNITS[0][2]
+    values = [ALL_DIGITS] * 81
+    values[0] = values[1] = pair
+    assert find_naked_pair(values, 0, [])
+    assert all(values[p] == ALL_DIGITS & ~pair for p in set(row_a + cube_a) - {0, 1})
+    assert values[27] == ALL_DIGITS
+    # Hidden pair: 1 and 2 can only go in A1 and A2 of row A, so those two squares lose their other values
+    values = [ALL_DIGITS] * 81
+    for p in row_a[2:]:
+        values[p] = ALL_DIGITS & ~pair
+    assert find_hidden_pair(values, row_a, DIGIT_MASK['1'], [0, 1], [])
+    assert values[0] == values[1] == pair
+    assert all(values[p] == ALL_DIGITS & ~pair for p in row_a[2:])
     print('All tests pass.')
 
 
 # Parse a Grid #
 
 def parse_grid(grid):
-    """Convert grid to a dict of possible values, {square: digits}, or
+    """Convert grid to a list of candidate masks, or
     return False if a contradiction is detected."""
     # To start, every square can be any digit; then assign values from the grid.
-    values = dict((s, digits) for s in squares)
-    for s, d in grid_values(grid).items():
-        if d in digits and not assign(values, s, d):
-            return False  # (Fail if we can't assign d to square s.)
+    values = [ALL_DIGITS] * 81
+    trail = []
+    for i, dmask in enumerate(grid_masks(grid)):
+        if dmask and not assign(values, i, dmask, trail):
+            return False  # (Fail if we can't assign dmask to square i.)
     return values
 
 
+def grid_masks(grid):
+    """Convert grid into a list of 81 masks of the given digits, with 0 for empties."""
+    masks = [GRID_CHAR_MASK[c] for c in grid if c in GRID_CHAR_MASK]
+    assert len(masks) == 81
+    return masks
+
+
 def grid_values(grid):
     """Convert grid into a dict of {square: char} with '0' or '.' for empties."""
     chars = [c for c in grid if c in digits or c in '0.']
@@ -68,43 +113,94 @@ def grid_values(grid):
     return dict(zip(squares, chars))
 
 
+def values_dict(values):
+    """Convert a list of candidate masks into a dict of {square: digits}."""
+    if values is False:
+        return False
+    return dict((s, MASK_DIGITS[m]) for s, m in zip(squares, values))
+
+
 # Constraint Propagation #
 
-def assign(values, s, d):
-    """Eliminate all the other values (except d) from values[s] and propagate.
+def assign(values, i, dmask, trail):
+    """Eliminate all the other values (except dmask) from values[i] and propagate.
     Return values, except return False if a contradiction is detected."""
-    other_values = values[s].replace(d, '')
-    if all(eliminate(values, s, d2) for d2 in other_values):
+    other_values = values[i] & ~dmask
+    if all(eliminate(values, i, b, trail) for b in MASK_BITS[other_values]):
         return values
     else:
         return False
 
 
-def eliminate(values, s, d):
-    """Eliminate d from values[s]; propagate when values or places <= 2.
+def eliminate(values, i, b, trail):
+    """Eliminate digit bit b from values[i]; propagate when values or places <= 2.
+    The old mask is pushed on trail as (i << 9) | mask so it can be restored by undo.
     Return values, except return False if a contradiction is detected."""
-    if d not in values[s]:
+    m = values[i]
+    if not m & b:
         return values  # Already eliminated
-    values[s] = values[s].replace(d, '')
-    # (1) If a square s is reduced to one value d2, then eliminate d2 from the peers.
-    if len(values[s]) == 0:
+    trail.append(i << 9 | m)
+    values[i] = m = m & ~b
+    # (1) If a square i is reduced to one value m, then eliminate m from the peers.
+    if not m:
         return False  # Contradiction: removed last value
-    elif len(values[s]) == 1:
-        d2 = values[s]
-        if not all(eliminate(values, s2, d2) for s2 in peers[s]):
+    elif not m & (m - 1):
+        if not all(eliminate(values, p, m, trail) for p in PEERS[i] if values[p] & m):
             return False
-    # (2) If a unit u is reduced to only one place for a value d, then put it there.
-    for u in units[s]:
-        d_places = [s for s in u if d in values[s]]
-        if len(d_places) == 0:
+    # (2) If a unit u is reduced to only one place for a value b, then put it there.
+    for u in UNITS[i]:
+        b_places = [p for p in u if values[p] & b]
+        if len(b_places) == 0:
             return False  # Contradiction: no place for this value
-        elif len(d_places) == 1:
-            # d can only be in one place in unit; assign it there
-            if not assign(values, d_places[0], d):
+        elif len(b_places) == 1:
+            # b can only be in one place in unit; assign it there
+            if not assign(values, b_places[0], b, trail):
                 return False
+        elif len(b_places) == 2 and not find_hidden_pair(values, u, b, b_places, trail):
+            return False
+    # (3) If a square i is reduced to two values, look for a naked pair with it.
+    if POPCOUNT[values[i]] == 2 and not find_naked_pair(values, i, trail):
+        return False
+    return values
+
+
+def find_naked_pair(values, i, trail):
+    """If another square of a unit of i has the same two values as i, the two squares
+    take both values, so eliminate them from the rest of the unit.
+    Return values, except return False if a contradiction is detected."""
+    m = values[i]
+    for u in UNITS[i]:
+        for p in u:
+            if p != i and values[p] == m:
+                if not all(eliminate(values, p2, b2, trail)
+                           for p2 in u if p2 != i and p2 != p
+                           for b2 in MASK_BITS[values[p2] & m]):
+                    return False
+                break
     return values
 
 
+def find_hidden_pair(values, u, b, b_places, trail):
+    """Value b can only go in the two squares b_places of unit u. If another value can
+    only go in those same two squares, they must hold the pair, so remove their other values.
+    Return values, except return False if a contradiction is detected."""
+    p1, p2 = b_places
+    for b2 in MASK_BITS[values[p1] & values[p2] & ~b]:
+        if not any(values[p] & b2 for p in u if p != p1 and p != p2):
+            pair = b | b2
+            if not (assign(values, p1, pair, trail) and assign(values, p2, pair, trail)):
+                return False
+            break
+    return values
+
+
+def undo(values, trail, mark):
+    """Restore the masks changed since trail was mark entries long."""
+    while len(trail) > mark:
+        e = trail.pop()
+        values[e >> 9] = e & ALL_DIGITS
+
+
 # Display as 2-D grid #
 
 def display(values):
@@ -122,31 +218,45 @@ def display(values):
 
 # def solve(grid: object) -> object: return randomsearch(parse_grid(grid))
 
-def solve(grid: object) -> object: return search(parse_grid(grid))
+def solve(grid: object) -> object: return values_dict(search(parse_grid(grid)))
 
 
 def search(values):
-    """Using depth-first search and propagation, try all possible values."""
+    """Using depth-first search and propagation, try all possible values.
+    The search works in place on values: instead of copying values at every
+    branch, the changed masks are recorded on a trail and undone on backtrack."""
     if values is False:
         return False  # Failed earlier
-    if all(len(values[s]) == 1 for s in squares):
-        return values  # Solved!
-    # Chose the unfilled square s with the fewest possibilities
-    _, s = min((len(values[s]), s) for s in squares if len(values[s]) > 1)
-    return some(search(assign(values.copy(), s, d))
-                for d in values[s])
+    trail = []
+    # Stack of open branches: (square, iterator over its untried digit bits, trail length before the branch,
+    # unfilled squares before the branch)
+    # Sibling branches put different digits in the same square, so no candidate state is ever
+    # reached twice and there are no dead states worth remembering.
+    branches = []
+    # Squares still unfilled; each step only rescans the squares that were unfilled before it
+    unfilled = list(range(81))
+    while True:
+        unfilled = [i for i in unfilled if POPCOUNT[values[i]] > 1]
+        if not unfilled:
+            return values  # Solved!
+        # Chose the unfilled square i with the fewest possibilities
+        _, i = min((POPCOUNT[values[i]], i) for i in unfilled)
+        branches.append((i, iter(MASK_BITS[values[i]]), len(trail), unfilled))
+        # Try the next digit of the innermost branch, backing up to the enclosing branch when it runs out
+        while branches:
+            i, candidates, mark, unfilled = branches[-1]
+            undo(values, trail, mark)
+            b = next(candidates, 0)
+            if not b:
+                branches.pop()
+            elif assign(values, i, b, trail):
+                break
+        else:
+            return False
 
 
 # Utilities #
 
-def some(seq):
-    """Return some element of seq that is true."""
-    for e in seq:
-        if e:
-            return e
-    return False
-
-
 def from_file(filename, sep='\n'):
     """Parse a file into a list of strings, separated by sep."""
     return open(filename).read().strip().split(sep)
@@ -161,15 +271,30 @@ def shuffled(seq):
 
 # System test #
 
-def solve_all(grids, name='', show_if=0.0):
+def time_solve(grid):
+    """Solve grid and return (values, seconds taken)."""
+    start = time.perf_counter()
+    values = solve(grid)
+    return values, time.perf_counter() - start
+
+
+def solve_all(grids, name='', show_if=0.0, workers=None):
     """Attempt to solve a sequence of grids. Report results.
     When show_if is a number of seconds, display puzzles that take longer.
-    When show_if is None, don't display any puzzles."""
+    When show_if is None, don't display any puzzles.
+    The puzzles are solved in a pool of workers processes (default: one per CPU);
+    a single puzzle or workers=1 solves them in this process."""
+    n = len(grids)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if n > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solutions = list(executor.map(time_solve, grids, chunksize=max(1, min(32, n // workers))))
+    else:
+        solutions = [time_solve(grid) for grid in grids]
 
-    def time_solve(grid):
-        start = time.perf_counter()  # change to perf_counter() because time.clock() is moved in Python 3.8
-        values = solve(grid)
-        t = time.perf_counter() - start  # change to perf_counter() because time.clock() is moved in Python 3.8
+    times, results = [], []
+    for grid, (values, t) in zip(grids, solutions):
         # Display puzzles that take long enough
         if show_if is not None and t > show_if:
             display(grid_values(grid))
@@ -177,10 +302,8 @@ def solve_all(grids, name='', show_if=0.0):
                 # noinspection PyTypeChecker
                 display(values)
             print('(%.3f seconds)\n' % t)
-        return t, solved(values)
-
-    times, results = zip(*[time_solve(grid) for grid in grids])
-    n = len(grids)
+        times.append(t)
+        results.append(solved(values))
     if n > 1:
         print("Solved %d of %d %s puzzles (avg %.3f secs (%d Hz), max %.3f secs)." % (
             sum(results), n, name, sum(times) / n, n / sum(times), max(times)))
@@ -189,7 +312,12 @@ def solve_all(grids, name='', show_if=0.0):
 def solved(values):
     """A puzzle is solved if each unit is a permutation of the digits 1 to 9."""
 
-    def unit_solved(unit): return set(values[s] for s in unit) == set(digits)
+    def unit_solved(unit):
+        # OR together the bit of each square's digit; squares with several digits add nothing
+        m = 0
+        for s in unit:
+            m |= DIGIT_MASK.get(values[s], 0)
+        return m == ALL_DIGITS
 
     return values is not False and all(unit_solved(unit) for unit in unit_list)
 
@@ -198,14 +326,16 @@ def random_puzzle(n=17):
     """Make a random puzzle with N or more assignments. Restart on contradictions.
     Note the resulting puzzle is not guaranteed to be solvable, but empirically
     about 99.8% of them are solvable. Some have multiple solutions."""
-    values = dict((s, digits) for s in squares)
-    for s in shuffled(squares):
-        if not assign(values, s, random.choice(values[s])):
-            break
-        ds = [values[s] for s in squares if len(values[s]) == 1]
-        if len(ds) >= n and len(set(ds)) >= 8:
-            return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
-    return random_puzzle(n)  # Give up and make a new puzzle
+    values = [ALL_DIGITS] * 81
+    trail = []
+    while True:
+        for i in shuffled(range(81)):
+            if not assign(values, i, random.choice(MASK_BITS[values[i]]), trail):
+                break
+            ds = [m for m in values if POPCOUNT[m] == 1]
+            if len(ds) >= n and len(set(ds)) >= 8:
+                return ''.join(MASK_DIGITS[m] if POPCOUNT[m] == 1 else '.' for m in values)
+        undo(values, trail, 0)  # Give up and make a new puzzle on the emptied grid
 
 
 grid1 = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
@@ -10,6 +10,10 @@
 #   u is a unit,   e.g. ['A1','B1','C1','D1','E1','F1','G1','H1','I1']
 #   grid is a grid,e.g. 81 non-blank chars, e.g. starting with '.18...7...
 #   values is a dict of possible values, e.g. {'A1':'12349', 'A2':'8', ...}
+import functools
+import itertools
+import multiprocessing
+import os
 import time
 import random
 import math
@@ -27,13 +31,20 @@ squares = cross(rows, cols)
 unit_list = ([cross(rows, c) for c in cols] +
              [cross(r, cols) for r in rows] +
              [cross(rs, cs) for rs in ('ABC', 'DEF', 'GHI') for cs in ('123', '456', '789')])
-cube = {s: [u for u in unit if u != s] for unit in unit_list for s in unit if len(unit) == 9}
+box_units = unit_list[18:]  # the 9 3*3 cubes
 units = dict((s, [u for u in unit_list if s in u])
              for s in squares)
-peers = dict((s, set(sum(units[s], [])) - {s})
+peers = dict((s, frozenset(itertools.chain.from_iterable(units[s])) - {s})
              for s in squares)
-unfixed = []
-values_tried = []
+cube = dict((s, [t for t in units[s][2] if t != s])  # units[s][2] is the 3*3 cube of s
+            for s in squares)
+# Inside the annealing loop the grid is a bytearray of 81 digits indexed like squares (0 for empties),
+# so square i is in row i // 9 and column i % 9
+SQ_IDX = dict((s, i) for i, s in enumerate(squares))
+DIGIT_MASK = dict((d, 1 << k) for k, d in enumerate(digits))
+ALL_DIGITS = 0x1FF
+GRID_CHARS = frozenset(digits + '0.')  # the characters of a grid that fill a square
+CUBE_IDX = [tuple(SQ_IDX[t] for t in cube[s]) for s in squares]
 
 
 # Unit Tests #
@@ -49,69 +60,97 @@ def test():
                            ['A1', 'A2', 'A3', 'B1', 'B2', 'B3', 'C1', 'C2', 'C3']]
     assert peers['C2'] == {'A2', 'B2', 'D2', 'E2', 'F2', 'G2', 'H2', 'I2', 'C1', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8',
                            'C9', 'A1', 'A3', 'B1', 'B3'}
+    grid = bytearray(range(1, 10)) * 9
+    row_cnt, col_cnt = line_counts(grid)
+    assert count_conflicts(row_cnt, col_cnt) == 72
+    delta = swap_squares(grid, row_cnt, col_cnt, 0, 10)
+    assert count_conflicts(row_cnt, col_cnt) == 72 + delta == count_conflicts(*line_counts(grid))
+    assert swap_squares(grid, row_cnt, col_cnt, 0, 10) == -delta
+    assert grid == bytearray(range(1, 10)) * 9
     print('All tests pass.')
 
 
 # Parse a Grid #
 
 def parse_grid(grid):
-    # Convert the grid into a dictionary of values
+    # Convert the grid into a dictionary of values, then fill the empty squares so that
+    # every cube holds each digit once. Also return the unfixed squares, the ones the search may change
     values = grid_values(grid)
-    # Iterate through each square in the grid
-    for s in squares:
-        # If the value of the square is '0' or '.', it needs to be filled
-        if values[s] in '0.':
-            # Get the values of the filled squares in the cube
-            filled_values = [values[i][0] for i in cube[s] if values[i] not in '0.']
-            # Get the possible values that can be filled in the square
-            possible_values = set(str(i) for i in range(1, 10)) - set(filled_values)
-            # If there are possible values, fill the square with a random choice
-            if possible_values:
-                values[s] = random.choice(list(possible_values))
-    # Return the filled grid
+    unfixed = [s for s in squares if values[s] in '0.']
+    return fill_cubes(values, set(unfixed)), unfixed
+
+
+def fill_cubes(values, non_fixed):
+    """Fill the non-fixed squares of every cube with a random permutation of the digits
+    missing from its fixed squares. Swaps within a cube keep every cube valid, so only
+    rows and columns can hold conflicts afterwards."""
+    for box in box_units:
+        empty = [s for s in box if s in non_fixed]
+        used = 0
+        for s in box:
+            if s not in non_fixed:
+                used |= DIGIT_MASK[values[s]]
+        missing = [d for d in digits if not used & DIGIT_MASK[d]]
+        random.shuffle(missing)
+        values.update(zip(empty, missing))
     return values
 
 
 def grid_values(grid):
-    # Clear the list of unfixed squares
-    unfixed.clear()
     # Convert the grid into a dictionary of {square: char} with '0' or '.' for empties
-    chars = [c for c in grid if c in digits or c in '0.']
+    chars = [c for c in grid if c in GRID_CHARS]
     # Assert that the grid has 81 characters (9x9 grid)
     assert len(chars) == 81
     # Create a dictionary mapping each square to its character
     make_grid = dict(zip(squares, chars))
-    # Extend the list of unfixed squares with the squares that are '0' or '.'
-    unfixed.extend(s for s in squares if make_grid[s] in '0.')
     # Return the grid
     return make_grid
 
 
 # Constraint Propagation #
 
-def get_conflicts(values):
-    """Calculate the number of conflicts in rows and cols only count non-fixed cells."""
-    conflicts = []
-    # Check rows
-    for i in 'ABCDEFGHI':
-        row = [values[i + j] for j in '123456789']
-        for digit in '123456789':
-            count = row.count(digit)
-            if count > 1:
-                for k in '123456789':
-                    if values[i + k] == digit:
-                        conflicts.append(i + k)
-    # Check columns
-    for j in '123456789':
-        col = [values[i + j] for i in 'ABCDEFGHI']
-        for digit in '123456789':
-            count = col.count(digit)
-            if count > 1:
-                for k in 'ABCDEFGHI':
-                    if values[k + j] == digit:
-                        conflicts.append(k + j)
-    final_conflicts = list(set(conflicts) & set(unfixed))
-    return final_conflicts
+def to_bytes(values):
+    """Convert a dict of {square: char} into a bytearray of 81 digits, with 0 for empties."""
+    return bytearray(digits.find(values[s]) + 1 for s in squares)
+
+
+def from_bytes(grid):
+    """Convert a bytearray of 81 digits back into a dict of {square: char}."""
+    return dict((s, digits[d - 1] if d else '.') for s, d in zip(squares, grid))
+
+
+def line_counts(grid):
+    """Count the digits of every row and column: row_cnt[r][d] and col_cnt[c][d], with d = 0 for empties."""
+    row_cnt = [[0] * 10 for _ in rows]
+    col_cnt = [[0] * 10 for _ in cols]
+    for i, d in enumerate(grid):
+        row_cnt[i // 9][d] += 1
+        col_cnt[i % 9][d] += 1
+    return row_cnt, col_cnt
+
+
+def count_conflicts(row_cnt, col_cnt):
+    """Count the extra copies of each digit in every row and column."""
+    return sum(n - 1 for cnt in row_cnt + col_cnt for n in cnt[1:] if n > 1)
+
+
+def swap_squares(grid, row_cnt, col_cnt, a, b):
+    """Swap the digits of squares a and b and update the row/column counts to match.
+    Return the change in count_conflicts, computed from the 4 lines touched by the swap."""
+    da, db = grid[a], grid[b]
+    delta = 0
+    for cnt, d_out, d_in in ((row_cnt[a // 9], da, db), (row_cnt[b // 9], db, da),
+                             (col_cnt[a % 9], da, db), (col_cnt[b % 9], db, da)):
+        # Removing a copy of d_out clears a conflict if it was duplicated,
+        # adding a copy of d_in makes one if it is already there
+        if d_out and cnt[d_out] > 1:
+            delta -= 1
+        cnt[d_out] -= 1
+        if d_in and cnt[d_in] > 0:
+            delta += 1
+        cnt[d_in] += 1
+    grid[a], grid[b] = db, da
+    return delta
 
 
 # Display as 2-D grid #
@@ -129,98 +168,150 @@ def display(values):
 
 # Search #
 
-def solve(grid: object) -> object: return simulated_annealing(parse_grid(grid))
+def solve(grid: object) -> object: return simulated_annealing(*parse_grid(grid))
+
+
+def solve_parallel(grid, runs=None):
+    """Run several annealing chains on grid at once, one per process with its own seed
+    (default: one per CPU). Return the first solution found, or the last chain's result
+    if none of them solves the puzzle."""
+    runs = runs or os.cpu_count() or 1
+    seed = random.randrange(1 << 32)
+    values = False
+    with multiprocessing.Pool(runs) as pool:
+        for values in pool.imap_unordered(functools.partial(anneal_seeded, grid), range(seed, seed + runs)):
+            if solved(values):
+                break  # Leaving the pool terminates the chains still running
+    return values
 
 
-def simulated_annealing(values, max_iteration=50000):
-    """Using simulated annealing."""
-    current = values.copy()
-    current_conflicts = get_conflicts(current.copy())
-    # Score the current state based on the number of conflicts
-    current_score = len(current_conflicts)
-    # Initialize temperature parameters for simulated annealing
-    t_initial = 3.0
+def anneal_seeded(grid, seed):
+    """Solve grid by simulated annealing after seeding the random generator with seed."""
+    random.seed(seed)
+    return solve(grid)
+
+
+def simulated_annealing(values, unfixed, max_iteration=50000):
+    """Using simulated annealing, changing only the unfixed squares."""
+    current = to_bytes(values)
+    # Score the current state based on the number of conflicts, then keep it up to date
+    # from the row and column digit counts as squares get swapped
+    row_cnt, col_cnt = line_counts(current)
+    current_score = count_conflicts(row_cnt, col_cnt)
+    # Only non-fixed squares with a non-fixed partner in their cube can be swapped
+    unfixed_idx = [SQ_IDX[s] for s in unfixed]
+    cube_unfixed = unfixed_cube_peers(unfixed_idx)
+    swappable = [i for i in unfixed_idx if cube_unfixed[i]]
+    # Initialize temperature parameters for simulated annealing: start where an average
+    # worsening move is accepted half the time, then cool faster or slower depending on
+    # how many of the last 200 moves were accepted
+    t_initial = initial_temperature(current, row_cnt, col_cnt, swappable, cube_unfixed)
     t = t_initial
-    t_min = 1e-126
+    t_min = 1e-6
     alpha = 0.99
+    # The acceptance window holds the outcome of the last 200 moves since the last (re)heat
+    window = bytearray(200)
+    moves = accepted = 0
+    # Acceptance probabilities exp(-delta / t) for each possible worsening delta (a swap
+    # touches 4 lines, so delta <= 4), rebuilt whenever t has dropped 10% below t_table
+    acceptance = [math.exp(-d / t) for d in range(5)]
+    t_table = t
     # Initialize iteration and restart counters
     iteration = 0
     restart = 0
+    # The loop runs up to max_iteration times, so look its functions up once
+    rand, swap, neighbor_of = random.random, swap_squares, generate_neighbor
 
-    while t > t_min and iteration <= max_iteration:
+    while iteration <= max_iteration:
         iteration += 1
         # Generate a neighbor state
-        neighbor = generate_neighbor(current, unfixed)
+        neighbor = neighbor_of(swappable, cube_unfixed)
         if (not neighbor) or (current_score == 0):
-            return current.copy()
-        # Evaluate the neighbor state
-        next_neighbor = neighbor
-        next_conflicts = get_conflicts(next_neighbor)
-        next_score = len(next_conflicts)
-        # Calculate the difference in score between the neighbor and the current state
-        delta = next_score - current_score
-        # If the neighbor state is better or the probability condition is met, move to the neighbor state
-        if delta < 0 or random.uniform(0, 1) < math.exp(-delta / t):
-            current, current_conflicts, current_score = next_neighbor, next_conflicts, next_score
+            return from_bytes(current)
+        # Move to the neighbor state and get the difference in score with the current state
+        i, j = neighbor
+        delta = swap(current, row_cnt, col_cnt, i, j)
+        # If the neighbor state is better or the probability condition is met, stay in the neighbor state
+        k = moves % 200
+        moves += 1
+        accepted -= window[k]
+        if delta <= 0 or rand() < acceptance[delta]:
+            current_score += delta
             restart = 0
+            window[k] = 1
+            accepted += 1
         else:
-            # If not, increment the restart counter
+            # If not, swap back and increment the restart counter
+            swap(current, row_cnt, col_cnt, i, j)
             restart += 1
-        # Decrease the temperature
-        t = t * alpha
-        # If the restart counter reaches 1000, reheat the system
-        if restart >= 1000:
+            window[k] = 0
+        # Decrease the temperature, quickly while most moves are accepted and slowly once
+        # few are; until the window has filled, its empty slots count as rejections
+        rate = accepted / 200
+        if rate > 0.5:
+            t = t * 0.95
+        elif rate < 0.1:
+            t = t * 0.999
+        else:
+            t = t * alpha
+        if t < 0.9 * t_table:
+            acceptance = [math.exp(-d / t) for d in range(5)]
+            t_table = t
+        # If the restart counter reaches 1000 or the system has frozen, reheat it
+        if restart >= 1000 or t < t_min:
             restart = 0
-            values = reheat(values, unfixed)
+            current = to_bytes(reheat(values, unfixed))
+            row_cnt, col_cnt = line_counts(current)
+            current_score = count_conflicts(row_cnt, col_cnt)
             t = t_initial
+            acceptance = [math.exp(-d / t) for d in range(5)]
+            t_table = t
+            window = bytearray(200)
+            moves = accepted = 0
     # Return the final state
-    return current.copy()
-
-
-def generate_neighbor(values, non_fixed):
-    # Initialize the maximum number of attempts to generate a neighbor
-    max_attempts = 500
-    attempts = 0
-    # Randomly select a square
-    i = random.choice(squares)
-    # If the square is not in the list of non-fixed squares, select another square
-    while i not in non_fixed and attempts < max_attempts:
-        i = random.choice(squares)
-        attempts += 1
-    # If the maximum number of attempts is reached, return the original values
-    if attempts == max_attempts:
-        return values
-    # Randomly select another square in the same cube
-    j = random.choice(cube[i])
-    # If the second square is not in the list of non-fixed squares or
-    # is the same as the first square, select another square
-    while i not in non_fixed or i == j and attempts < max_attempts:
-        j = random.choice(cube[i])
-        attempts += 1
-    if attempts == max_attempts:
-        return values
-    # Swap the values of the two squares to generate a neighbor
-    neighbor = values.copy()
-    neighbor[i], neighbor[j] = neighbor[j], neighbor[i]
-    return neighbor
+    return from_bytes(current)
+
+
+def initial_temperature(grid, row_cnt, col_cnt, non_fixed, cube_unfixed, moves=100, p_accept=0.5):
+    """Try moves random swaps on grid, undoing each, and return the temperature at which
+    a move worsening the score by their average |delta| is accepted with probability p_accept."""
+    total = 0
+    for _ in range(moves):
+        neighbor = generate_neighbor(non_fixed, cube_unfixed)
+        if not neighbor:
+            break
+        total += abs(swap_squares(grid, row_cnt, col_cnt, *neighbor))
+        swap_squares(grid, row_cnt, col_cnt, *neighbor)
+    # exp(-mean / t) == p_accept; fall back to 3.0 when no move changed the score
+    return (total / moves) / -math.log(p_accept) if total else 3.0
+
+
+def generate_neighbor(non_fixed, cube_unfixed):
+    """Pick two non-fixed squares of the same cube to swap, or return None if there are none.
+    non_fixed lists the squares that share their cube with another non-fixed square,
+    and cube_unfixed[s] lists those other squares."""
+    if not non_fixed:
+        return None
+    randrange = random.randrange
+    # Randomly select a non-fixed square, then another non-fixed square in the same cube
+    i = non_fixed[randrange(len(non_fixed))]
+    swappable = cube_unfixed[i]
+    j = swappable[randrange(len(swappable))]
+    # The two squares whose values are swapped to generate a neighbor
+    return i, j
+
+
+def unfixed_cube_peers(non_fixed):
+    """Map every non-fixed square index to the other non-fixed square indexes of its cube."""
+    non_fixed_set = set(non_fixed)
+    return dict((i, [j for j in CUBE_IDX[i] if j in non_fixed_set]) for i in non_fixed)
 
 
 def reheat(values, non_fixed):
     """A random-restart mechanism to the algorithm: If no improvement
     in cost is made for a fixed number of Markov chains (there is set to 1000),
-    then t is reset to its initial setting"""
-    restart = values.copy()
-    for s in squares:
-        # If the square is in the list of non-fixed squares
-        if s in unfixed:
-            # Get the filled values in the same cube
-            filled_values = [values[i][0] for i in cube[s] if i not in non_fixed]
-            # Get the possible values that can be filled in the square
-            possible_values = set(str(i) for i in range(1, 10)) - set(filled_values)
-            # If there are possible values, fill the square with a random choice
-            if possible_values:
-                restart[s] = random.choice(list(possible_values))
-    return restart
+    then t is reset to its initial setting and the non-fixed squares are refilled"""
+    return fill_cubes(values.copy(), set(non_fixed))
 
 
 # Utilities #
@@ -233,14 +324,16 @@ def from_file(filename, sep='\n'):
 
 # System test #
 
-def solve_all(grids, name='', show_if=0.0):
+def solve_all(grids, name='', show_if=0.0, chains=1):
     """Attempt to solve a sequence of grids. Report results.
     When show_if is a number of seconds, display puzzles that take longer.
-    When show_if is None, don't display any puzzles."""
+    When show_if is None, don't display any puzzles.
+    When chains is more than 1, each puzzle is attacked by that many annealing
+    chains in parallel processes (see solve_parallel)."""
 
     def time_solve(grid):
         start = time.perf_counter()
-        values = solve(grid)
+        values = solve_parallel(grid, chains) if chains > 1 else solve(grid)
         t = time.perf_counter() - start
         # Display puzzles that take long enough
         if show_if is not None and t > show_if:
@@ -261,7 +354,12 @@ def solve_all(grids, name='', show_if=0.0):
 def solved(values):
     """A puzzle is solved if each unit is a permutation of the digits 1 to 9."""
 
-    def unit_solved(unit): return set(values[s] for s in unit) == set(digits)
+    def unit_solved(unit):
+        # OR together the bit of each square's digit; empty squares add nothing
+        m = 0
+        for s in unit:
+            m |= DIGIT_MASK.get(values[s], 0)
+        return m == ALL_DIGITS
 
     return values is not False and all(unit_solved(unit) for unit in unit_list)
 
@@ -12,12 +12,14 @@ import random
 #   u is a unit,   e.g. ['A1','B1','C1','D1','E1','F1','G1','H1','I1']
 #   grid is a grid,e.g. 81 non-blank chars, e.g. starting with '.18...7...
 #   values is a dict of possible values, e.g. {'A1':'12349', 'A2':'8', ...}
+import itertools
+import sys
 import time
 
 
 def cross(front, back):
     """Cross product of elements in A and elements in B."""
-    return [a + b for a in front for b in back]
+    return [sys.intern(a + b) for a in front for b in back]
 
 
 digits = '123456789'
@@ -29,8 +31,14 @@ unit_list = ([cross(rows, c) for c in cols] +
              [cross(rs, cs) for rs in ('ABC', 'DEF', 'GHI') for cs in ('123', '456', '789')])
 units = dict((s, [u for u in unit_list if s in u])
              for s in squares)
-peers = dict((s, set(sum(units[s], [])) - {s})
+peers = dict((s, frozenset(itertools.chain.from_iterable(units[s])) - {s})
              for s in squares)
+# Tuple copies of units and peers for the propagation hot path
+UNITS_TUP = dict((s, tuple(tuple(u) for u in units[s])) for s in squares)
+PEERS_TUP = dict((s, tuple(peers[s])) for s in squares)
+# Bit of each digit, used to check solved units
+DIGIT_MASK = dict((d, 1 << k) for k, d in enumerate(digits))
+ALL_DIGITS = 0x1FF
 peer = dict((s, [sorted([u for u in unit if u != s]) for unit in units[s]])
             for s in squares)
 
@@ -104,10 +112,10 @@ def eliminate(values, s, d):
         return False  # Contradiction: removed last value
     elif len(values[s]) == 1:
         d2 = values[s]
-        if not all(eliminate(values, s2, d2) for s2 in peers[s]):
+        if not all(eliminate(values, s2, d2) for s2 in PEERS_TUP[s]):
             return False
     # (2) If a unit u is reduced to only one place for a value d, then put it there.
-    for u in units[s]:
+    for u in UNITS_TUP[s]:
         d_places = [s for s in u if d in values[s]]
         if len(d_places) == 0:
             return False  # Contradiction: no place for this value
@@ -243,7 +251,12 @@ def solve_all(grids, name='', show_if=0.0):
 def solved(values):
     """A puzzle is solved if each unit is a permutation of the digits 1 to 9."""
 
-    def unit_solved(unit): return set(values[s] for s in unit) == set(digits)
+    def unit_solved(unit):
+        # OR together the bit of each square's digit; squares with several digits add nothing
+        m = 0
+        for s in unit:
+            m |= DIGIT_MASK.get(values[s], 0)
+        return m == ALL_DIGITS
 
     return values is not False and all(unit_solved(unit) for unit in unit_list)
 
@@ -252,14 +265,15 @@ def random_puzzle(n=17):
     """Make a random puzzle with N or more assignments. Restart on contradictions.
     Note the resulting puzzle is not guaranteed to be solvable, but empirically
     about 99.8% of them are solvable. Some have multiple solutions."""
-    values = dict((s, digits) for s in squares)
-    for s in shuffled(squares):
-        if not assign(values, s, random.choice(values[s])):
-            break
-        ds = [values[s] for s in squares if len(values[s]) == 1]
-        if len(ds) >= n and len(set(ds)) >= 8:
-            return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
-    return random_puzzle(n)  # Give up and make a new puzzle
+    while True:
+        values = dict((s, digits) for s in squares)
+        for s in shuffled(squares):
+            if not assign(values, s, random.choice(values[s])):
+                break
+            ds = [values[s] for s in squares if len(values[s]) == 1]
+            if len(ds) >= n and len(set(ds)) >= 8:
+                return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
+        # Give up and make a new puzzle
 
 
 grid1 = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
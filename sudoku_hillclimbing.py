@@ -11,8 +11,11 @@ import itertools
 #   u is a unit,   e.g. ['A1','B1','C1','D1','E1','F1','G1','H1','I1']
 #   grid is a grid,e.g. 81 non-blank chars, e.g. starting with '.18...7...
 #   values is a dict of possible values, e.g. {'A1':'12349', 'A2':'8', ...}
+import collections
+import os
 import time
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 
 def cross(front, back):
@@ -27,12 +30,18 @@ squares = cross(rows, cols)
 unit_list = ([cross(rows, c) for c in cols] +
              [cross(r, cols) for r in rows] +
              [cross(rs, cs) for rs in ('ABC', 'DEF', 'GHI') for cs in ('123', '456', '789')])
-cube = {s: [u for u in unit if u != s] for unit in unit_list for s in unit if len(unit) == 9}
+box_units = unit_list[18:]  # the 9 3*3 cubes
 units = dict((s, [u for u in unit_list if s in u])
              for s in squares)
-peers = dict((s, set(sum(units[s], [])) - {s})
+peers = dict((s, frozenset(itertools.chain.from_iterable(units[s])) - {s})
              for s in squares)
-unfixed = []
+# Inside hill climbing the grid is a bytearray of 81 digits indexed like squares (0 for empties),
+# so square i is in row i // 9 and column i % 9
+SQ_IDX = dict((s, i) for i, s in enumerate(squares))
+DIGIT_MASK = dict((d, 1 << k) for k, d in enumerate(digits))
+ALL_DIGITS = 0x1FF
+GRID_CHARS = frozenset(digits + '0.')  # the characters of a grid that fill a square
+BOX_IDX = [tuple(SQ_IDX[s] for s in box) for box in box_units]
 
 
 # Unit Tests #
@@ -48,69 +57,139 @@ def test():
                            ['A1', 'A2', 'A3', 'B1', 'B2', 'B3', 'C1', 'C2', 'C3']]
     assert peers['C2'] == {'A2', 'B2', 'D2', 'E2', 'F2', 'G2', 'H2', 'I2', 'C1', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8',
                            'C9', 'A1', 'A3', 'B1', 'B3'}
+    grid = bytearray(range(1, 10)) * 9
+    row_cnt, col_cnt = line_counts(grid)
+    assert count_conflicts(row_cnt, col_cnt) == 72
+    assert swap_delta(grid, row_cnt, col_cnt, 0, 10) == 0
+    assert swap_delta(grid, row_cnt, col_cnt, 0, 1) == -2
+    delta = swap_squares(grid, row_cnt, col_cnt, 0, 10)
+    assert count_conflicts(row_cnt, col_cnt) == 72 + delta == count_conflicts(*line_counts(grid))
+    assert swap_squares(grid, row_cnt, col_cnt, 0, 10) == -delta
+    assert grid == bytearray(range(1, 10)) * 9
+    # Two empty squares in a row are not a conflict, so moving one of them away clears nothing
+    grid[0] = grid[2] = 0
+    row_cnt, col_cnt = line_counts(grid)
+    assert swap_delta(grid, row_cnt, col_cnt, 0, 10) == swap_squares(grid, row_cnt, col_cnt, 0, 10) == 0
+    # On a solved grid every swap is worse: escape with the first least bad one and make it tabu,
+    # after which undoing it is the best improving swap but must not be taken
+    grid = bytearray((r * 3 + r // 3 + c) % 9 + 1 for r in range(9) for c in range(9))
+    row_cnt, col_cnt = line_counts(grid)
+    neighbors = list(itertools.combinations(BOX_IDX[0], 2))
+    tabu = collections.deque(maxlen=7)
+    assert improving_swap(grid, row_cnt, col_cnt, neighbors, tabu) == (None, 0)
+    escape, delta = escape_swap(grid, row_cnt, col_cnt, neighbors, tabu)
+    assert escape == (0, 1) and delta > 0
+    swap_squares(grid, row_cnt, col_cnt, *escape)
+    tabu.append(escape)
+    assert improving_swap(grid, row_cnt, col_cnt, neighbors, (), False) == (escape, -delta)
+    assert improving_swap(grid, row_cnt, col_cnt, neighbors, tabu, False)[0] != escape
+    assert escape_swap(grid, row_cnt, col_cnt, neighbors, tabu)[0] != escape
     print('All tests pass.')
 
 
 # Parse a Grid #
 
 def parse_grid(grid):
-    # Convert the grid into a dictionary of values
+    # Convert the grid into a dictionary of values, then fill the empty squares so that
+    # every cube holds each digit once. Also return the unfixed squares, the ones the search may change
     values = grid_values(grid)
-    # Iterate through each square in the grid
-    for s in squares:
-        # If the value of the square is '0' or '.', it needs to be filled
-        if values[s] in '0.':
-            # Get the values of the filled squares in the cube
-            filled_values = [values[i][0] for i in cube[s] if values[i] not in '0.']
-            # Get the possible values that can be filled in the square
-            possible_values = set(str(i) for i in range(1, 10)) - set(filled_values)
-            # If there are possible values, fill the square with a random choice
-            if possible_values:
-                values[s] = random.choice(list(possible_values))
-    # Return the filled grid
+    unfixed = [s for s in squares if values[s] in '0.']
+    return fill_cubes(values, set(unfixed)), unfixed
+
+
+def fill_cubes(values, non_fixed):
+    """Fill the non-fixed squares of every cube with a random permutation of the digits
+    missing from its fixed squares. Swaps within a cube keep every cube valid, so only
+    rows and columns can hold conflicts afterwards."""
+    for box in box_units:
+        empty = [s for s in box if s in non_fixed]
+        used = 0
+        for s in box:
+            if s not in non_fixed:
+                used |= DIGIT_MASK[values[s]]
+        missing = [d for d in digits if not used & DIGIT_MASK[d]]
+        random.shuffle(missing)
+        values.update(zip(empty, missing))
     return values
 
 
 def grid_values(grid):
-    # Clear the list of unfixed squares
-    unfixed.clear()
     # Convert the grid into a dictionary of {square: char} with '0' or '.' for empties
-    chars = [c for c in grid if c in digits or c in '0.']
+    chars = [c for c in grid if c in GRID_CHARS]
     # Assert that the grid has 81 characters (9x9 grid)
     assert len(chars) == 81
     # Create a dictionary mapping each square to its character
     make_grid = dict(zip(squares, chars))
-    # Extend the list of unfixed squares with the squares that are '0' or '.'
-    unfixed.extend(s for s in squares if make_grid[s] in '0.')
     # Return the grid
     return make_grid
 
 
 # Constraint Propagation #
 
-def get_conflicts(values):
-    """Calculate the number of conflicts in rows and cols only count non-fixed cells."""
-    conflicts = []
-    # Check rows
-    for i in 'ABCDEFGHI':
-        row = [values[i + j] for j in '123456789']
-        for digit in '123456789':
-            count = row.count(digit)
-            if count > 1:
-                for k in '123456789':
-                    if values[i + k] == digit:
-                        conflicts.append(i + k)
-    # Check columns
-    for j in '123456789':
-        col = [values[i + j] for i in 'ABCDEFGHI']
-        for digit in '123456789':
-            count = col.count(digit)
-            if count > 1:
-                for k in 'ABCDEFGHI':
-                    if values[k + j] == digit:
-                        conflicts.append(k + j)
-    final_conflicts = list(set(conflicts) & set(unfixed))
-    return final_conflicts
+def to_bytes(values):
+    """Convert a dict of {square: char} into a bytearray of 81 digits, with 0 for empties."""
+    return bytearray(digits.find(values[s]) + 1 for s in squares)
+
+
+def from_bytes(grid):
+    """Convert a bytearray of 81 digits back into a dict of {square: char}."""
+    return dict((s, digits[d - 1] if d else '.') for s, d in zip(squares, grid))
+
+
+def line_counts(grid):
+    """Count the digits of every row and column: row_cnt[r][d] and col_cnt[c][d], with d = 0 for empties."""
+    row_cnt = [[0] * 10 for _ in rows]
+    col_cnt = [[0] * 10 for _ in cols]
+    for i, d in enumerate(grid):
+        row_cnt[i // 9][d] += 1
+        col_cnt[i % 9][d] += 1
+    return row_cnt, col_cnt
+
+
+def count_conflicts(row_cnt, col_cnt):
+    """Count the extra copies of each digit in every row and column."""
+    return sum(n - 1 for cnt in row_cnt + col_cnt for n in cnt[1:] if n > 1)
+
+
+def swap_squares(grid, row_cnt, col_cnt, a, b):
+    """Swap the digits of squares a and b and update the row/column counts to match.
+    Return the change in count_conflicts, computed from the 4 lines touched by the swap."""
+    da, db = grid[a], grid[b]
+    delta = 0
+    for cnt, d_out, d_in in ((row_cnt[a // 9], da, db), (row_cnt[b // 9], db, da),
+                             (col_cnt[a % 9], da, db), (col_cnt[b % 9], db, da)):
+        # Removing a copy of d_out clears a conflict if it was duplicated,
+        # adding a copy of d_in makes one if it is already there
+        if d_out and cnt[d_out] > 1:
+            delta -= 1
+        cnt[d_out] -= 1
+        if d_in and cnt[d_in] > 0:
+            delta += 1
+        cnt[d_in] += 1
+    grid[a], grid[b] = db, da
+    return delta
+
+
+def swap_delta(grid, row_cnt, col_cnt, a, b):
+    """Return the change in count_conflicts that swapping the digits of squares a and b
+    would make, without swapping them. Empty squares (0) count as no digit, as in swap_squares."""
+    da, db = grid[a], grid[b]
+    delta = 0
+    # A line holding both squares keeps its digits; otherwise it loses one digit and gains the other:
+    # losing a duplicated digit clears a conflict, gaining a digit already there makes one
+    ra, rb = a // 9, b // 9
+    if ra != rb:
+        cnt = row_cnt[ra]
+        delta += (db and cnt[db] > 0) - (da and cnt[da] > 1)
+        cnt = row_cnt[rb]
+        delta += (da and cnt[da] > 0) - (db and cnt[db] > 1)
+    ca, cb = a % 9, b % 9
+    if ca != cb:
+        cnt = col_cnt[ca]
+        delta += (db and cnt[db] > 0) - (da and cnt[da] > 1)
+        cnt = col_cnt[cb]
+        delta += (da and cnt[da] > 0) - (db and cnt[db] > 1)
+    return delta
 
 
 # Display as 2-D grid #
@@ -128,60 +207,115 @@ def display(values):
 
 # Search #
 
-def solve(grid: object) -> object: return hill_climbing(parse_grid(grid))
+def solve(grid: object) -> object: return restart_climbing(grid)
 
 
-def hill_climbing(value):
-    # Parse the grid and initialize values
-    values = value
-    # Get the current number of conflicts
-    current_conflicts = len(get_conflicts(values))
-
-    while True:
-        # Generate all neighbors
-        neighbors = generate_all_neighbors(values)
-        # Evaluate neighbors
-        best_neighbor = None
-        best_conflicts = current_conflicts
-        # If the best conflict is 0, return the values
-        if best_conflicts == 0:
-            return values
-        # Iterate through all neighbors
-        for neighbor in neighbors:
-            # Get the number of conflicts of the neighbor
-            neighbor_conflicts = len(get_conflicts(neighbor))
-            # If the neighbor has fewer conflicts, update the best neighbor and the best conflicts
-            if neighbor_conflicts < best_conflicts:
-                best_neighbor = neighbor
-                best_conflicts = neighbor_conflicts
-        # If no better neighbor is found, or the best conflicts are not less than the current conflicts, break the loop
-        if best_neighbor is None or best_conflicts >= current_conflicts:
+def restart_climbing(grid, restarts=20, tabu_size=7, max_stall=100):
+    """Climb from up to restarts fresh random fillings of grid, stopping at the first solution.
+    Return the climb that ended with the fewest conflicts."""
+    best, best_conflicts = False, None
+    for _ in range(restarts):
+        values, conflicts = hill_climbing(*parse_grid(grid), tabu_size=tabu_size, max_stall=max_stall)
+        if best_conflicts is None or conflicts < best_conflicts:
+            best, best_conflicts = values, conflicts
+        if conflicts == 0:
             break
-        # Move to the best neighbor
-        values = best_neighbor
-        current_conflicts = best_conflicts
-    return values
+    return best
+
+
+def hill_climbing(value, unfixed, first_improvement=True, tabu_size=0, max_stall=0):
+    """Climb from value by swapping unfixed squares within cubes until no swap lowers the
+    number of conflicts. Take the first improving swap of each sweep, or the best one
+    when first_improvement is False.
+    With max_stall > 0, a local minimum does not end the climb: make the least bad swap
+    that is not among the last tabu_size swaps taken that way, and give up after max_stall
+    moves in a row that do not beat the best state seen, which is the one returned.
+    Tabu swaps are skipped by the improving sweeps too, so an escape is not undone at once.
+    Return the values reached and their number of conflicts."""
+    # Work on a bytearray of the digits of the filled grid
+    values = to_bytes(value)
+    # Get the current number of conflicts, kept up to date from the row and column digit counts
+    row_cnt, col_cnt = line_counts(values)
+    current_conflicts = count_conflicts(row_cnt, col_cnt)
+    # Swaps stay inside cubes and never touch fixed squares, so the candidate pairs are the same every step
+    neighbors = generate_all_neighbors(values, unfixed)
+    # Remember the best state and the recent escape moves
+    best, best_conflicts = bytes(values), current_conflicts
+    tabu = collections.deque(maxlen=tabu_size)
+    stall = 0
 
-
-def generate_all_neighbors(values):
+    while True:
+        # If the current conflict is 0, return the values
+        if current_conflicts == 0:
+            return from_bytes(values), 0
+        # Score the swaps from the digit counts
+        best_swap, best_delta = improving_swap(values, row_cnt, col_cnt, neighbors, tabu, first_improvement)
+        # If no better neighbor is found, escape with the least bad swap that is not tabu
+        if best_swap is None:
+            if stall >= max_stall:
+                break
+            best_swap, best_delta = escape_swap(values, row_cnt, col_cnt, neighbors, tabu)
+            if best_swap is None:
+                break
+            tabu.append(best_swap)
+        # Move to the chosen neighbor
+        swap_squares(values, row_cnt, col_cnt, *best_swap)
+        current_conflicts += best_delta
+        if current_conflicts < best_conflicts:
+            best, best_conflicts = bytes(values), current_conflicts
+            stall = 0
+        else:
+            stall += 1
+    return from_bytes(best), best_conflicts
+
+
+def improving_swap(values, row_cnt, col_cnt, neighbors, tabu, first_improvement=True):
+    """Return the first swap of neighbors that lowers the number of conflicts, or the best one
+    when first_improvement is False, with its delta; skip the swaps in tabu.
+    Return (None, 0) if no swap is better."""
+    # Every sweep scores each pair, so look the scoring function up once
+    delta_of = swap_delta
+    best_swap = None
+    best_delta = 0
+    for square1, square2 in neighbors:
+        if (square1, square2) in tabu:
+            continue
+        # Get the change in the number of conflicts of the neighbor
+        delta = delta_of(values, row_cnt, col_cnt, square1, square2)
+        # If the neighbor has fewer conflicts, update the best swap and the best delta
+        if delta < best_delta:
+            best_swap = square1, square2
+            best_delta = delta
+            # Settle for the first better neighbor unless asked for the best one
+            if first_improvement:
+                break
+    return best_swap, best_delta
+
+
+def escape_swap(values, row_cnt, col_cnt, neighbors, tabu):
+    """Return the first swap of neighbors not in tabu with the smallest delta, and that delta,
+    or (None, None) if every swap is tabu."""
+    best_swap = best_delta = None
+    for swap in neighbors:
+        if swap not in tabu:
+            delta = swap_delta(values, row_cnt, col_cnt, *swap)
+            if best_delta is None or delta < best_delta:
+                best_swap, best_delta = swap, delta
+    return best_swap, best_delta
+
+
+def generate_all_neighbors(values, unfixed):
+    """List the pairs of unfilled square indexes of the same cube whose swap gives a neighbor of values."""
     neighbors = []
-    # get a represent for every 3*3 cube
-    s_values = ['A1', 'A4', 'A7', 'D1', 'D4', 'D7', 'H1', 'H4', 'H7']
-    for s in s_values:
-        # Get the unfilled squares
-        unfilled_squares = [sq for sq in cube[s] if sq in unfixed]
+    unfixed_idx = set(SQ_IDX[s] for s in unfixed)
+    for box in BOX_IDX:
+        # Get the unfilled squares of every 3*3 cube
+        unfilled_squares = [i for i in box if i in unfixed_idx]
         # If there are less than 2 unfilled squares, continue to the next square
         if len(unfilled_squares) < 2:
             continue
-        # Generate all combinations of 2 unfilled squares
-        combinations = list(itertools.combinations(unfilled_squares, 2))
-        for c in combinations:
-            # Swap the values of the two squares in each combination
-            square1, square2 = c
-            new_values = values.copy()
-            new_values[square1], new_values[square2] = new_values[square2], new_values[square1]
-            # Add the new values to the list of neighbors
-            neighbors.append(new_values)
+        # Every combination of 2 unfilled squares is a swap giving a neighbor
+        neighbors.extend(itertools.combinations(unfilled_squares, 2))
     return neighbors
 
 
@@ -195,15 +329,30 @@ def from_file(filename, sep='\n'):
 
 # System test #
 
-def solve_all(grids, name='', show_if=0.0):
+def time_solve(grid):
+    """Solve grid and return (values, seconds taken)."""
+    start = time.perf_counter()  # change to perf_counter() because time.clock() is moved in Python 3.8
+    values = solve(grid)
+    return values, time.perf_counter() - start
+
+
+def solve_all(grids, name='', show_if=0.0, workers=None):
     """Attempt to solve a sequence of grids. Report results.
     When show_if is a number of seconds, display puzzles that take longer.
-    When show_if is None, don't display any puzzles."""
-
-    def time_solve(grid):
-        start = time.perf_counter()  # change to perf_counter() because time.clock() is moved in Python 3.8
-        values = solve(grid)
-        t = time.perf_counter() - start  # change to perf_counter() because time.clock() is moved in Python 3.8
+    When show_if is None, don't display any puzzles.
+    The puzzles are solved in a pool of workers processes (default: one per CPU);
+    a single puzzle or workers=1 solves them in this process."""
+    n = len(grids)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if n > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solutions = list(executor.map(time_solve, grids, chunksize=max(1, min(32, n // workers))))
+    else:
+        solutions = [time_solve(grid) for grid in grids]
+
+    times, results = [], []
+    for grid, (values, t) in zip(grids, solutions):
         # Display puzzles that take long enough
         if show_if is not None and t > show_if:
             display(grid_values(grid))
@@ -211,10 +360,8 @@ def solve_all(grids, name='', show_if=0.0):
                 # noinspection PyTypeChecker
                 display(values)
             print('(%.3f seconds)\n' % t)
-        return t, solved(values)
-
-    times, results = zip(*[time_solve(grid) for grid in grids])
-    n = len(grids)
+        times.append(t)
+        results.append(solved(values))
     if n > 1:
         print("Solved %d of %d %s puzzles (avg %.3f secs (%d Hz), max %.3f secs)." % (
             sum(results), n, name, sum(times) / n, n / sum(times), max(times)))
@@ -223,7 +370,12 @@ def solve_all(grids, name='', show_if=0.0):
 def solved(values):
     """A puzzle is solved if each unit is a permutation of the digits 1 to 9."""
 
-    def unit_solved(unit): return set(values[s] for s in unit) == set(digits)
+    def unit_solved(unit):
+        # OR together the bit of each square's digit; empty squares add nothing
+        m = 0
+        for s in unit:
+            m |= DIGIT_MASK.get(values[s], 0)
+        return m == ALL_DIGITS
 
     return values is not False and all(unit_solved(unit) for unit in unit_list)
 
@@ -11,13 +11,15 @@
 #   u is a unit,   e.g. ['A1','B1','C1','D1','E1','F1','G1','H1','I1']
 #   grid is a grid,e.g. 81 non-blank chars, e.g. starting with '.18...7...
 #   values is a dict of possible values, e.g. {'A1':'12349', 'A2':'8', ...}
+import itertools
+import sys
 import time
 import random
 
 
 def cross(front, back):
     """Cross product of elements in A and elements in B."""
-    return [a + b for a in front for b in back]
+    return [sys.intern(a + b) for a in front for b in back]
 
 
 digits = '123456789'
@@ -29,8 +31,14 @@ unit_list = ([cross(rows, c) for c in cols] +
              [cross(rs, cs) for rs in ('ABC', 'DEF', 'GHI') for cs in ('123', '456', '789')])
 units = dict((s, [u for u in unit_list if s in u])
              for s in squares)
-peers = dict((s, set(sum(units[s], [])) - {s})
+peers = dict((s, frozenset(itertools.chain.from_iterable(units[s])) - {s})
              for s in squares)
+# Tuple copies of units and peers for the propagation hot path
+UNITS_TUP = dict((s, tuple(tuple(u) for u in units[s])) for s in squares)
+PEERS_TUP = dict((s, tuple(peers[s])) for s in squares)
+# Bit of each digit, used to check solved units
+DIGIT_MASK = dict((d, 1 << k) for k, d in enumerate(digits))
+ALL_DIGITS = 0x1FF
 
 
 # Unit Tests #
@@ -56,8 +64,9 @@ def parse_grid(grid):
     return False if a contradiction is detected."""
     # To start, every square can be any digit; then assign values from the grid.
     values = dict((s, digits) for s in squares)
+    trail = []
     for s, d in grid_values(grid).items():
-        if d in digits and not assign(values, s, d):
+        if d in digits and not assign(values, s, d, trail):
             return False  # (Fail if we can't assign d to square s.)
     return values
 
@@ -71,41 +80,50 @@ def grid_values(grid):
 
 # Constraint Propagation #
 
-def assign(values, s, d):
+def assign(values, s, d, trail):
     """Eliminate all the other values (except d) from values[s] and propagate.
     Return values, except return False if a contradiction is detected."""
     other_values = values[s].replace(d, '')
-    if all(eliminate(values, s, d2) for d2 in other_values):
+    if all(eliminate(values, s, d2, trail) for d2 in other_values):
         return values
     else:
         return False
 
 
-def eliminate(values, s, d):
+def eliminate(values, s, d, trail):
     """Eliminate d from values[s]; propagate when values or places <= 2.
+    The old value is pushed on trail as (s, values[s]) so it can be restored by undo.
     Return values, except return False if a contradiction is detected."""
     if d not in values[s]:
         return values  # Already eliminated
+    trail.append((s, values[s]))
     values[s] = values[s].replace(d, '')
     # (1) If a square s is reduced to one value d2, then eliminate d2 from the peers.
     if len(values[s]) == 0:
         return False  # Contradiction: removed last value
     elif len(values[s]) == 1:
         d2 = values[s]
-        if not all(eliminate(values, s2, d2) for s2 in peers[s]):
+        if not all(eliminate(values, s2, d2, trail) for s2 in PEERS_TUP[s]):
             return False
     # (2) If a unit u is reduced to only one place for a value d, then put it there.
-    for u in units[s]:
+    for u in UNITS_TUP[s]:
         d_places = [s for s in u if d in values[s]]
         if len(d_places) == 0:
             return False  # Contradiction: no place for this value
         elif len(d_places) == 1:
             # d can only be in one place in unit; assign it there
-            if not assign(values, d_places[0], d):
+            if not assign(values, d_places[0], d, trail):
                 return False
     return values
 
 
+def undo(values, trail, mark):
+    """Restore the values changed since trail was mark entries long."""
+    while len(trail) > mark:
+        s, old = trail.pop()
+        values[s] = old
+
+
 # Display as 2-D grid #
 
 def display(values):
@@ -123,31 +141,30 @@ def display(values):
 
 # def solve(grid: object) -> object: return randomsearch(parse_grid(grid))
 
-def solve(grid: object) -> object: return randomsearch(parse_grid(grid))
+def solve(grid: object) -> object: return randomsearch(parse_grid(grid), [], squares)
 
 
-def randomsearch(values):
-    """Using depth-first search and propagation, try all possible values."""
+def randomsearch(values, trail, unfilled):
+    """Using depth-first search and propagation, try all possible values.
+    values is changed in place; a failed branch is rolled back with undo from trail.
+    unfilled holds the squares that were unfilled in the parent, only those are rescanned."""
     if values is False:
         return False  # Failed earlier
-    if all(len(values[s]) == 1 for s in squares):
+    unfilled = [s for s in unfilled if len(values[s]) > 1]
+    if not unfilled:
         return values  # Solved!
     # Chose the unfilled square s randomly
-    s = random.choice([s for s in squares if len(values[s]) > 1])
-    return some(randomsearch(assign(values.copy(), s, d))
-                for d in values[s])
+    s = random.choice(unfilled)
+    for d in values[s]:
+        mark = len(trail)
+        if randomsearch(assign(values, s, d, trail), trail, unfilled):
+            return values
+        undo(values, trail, mark)
+    return False
 
 
 # Utilities #
 
-def some(seq):
-    """Return some element of seq that is true."""
-    for e in seq:
-        if e:
-            return e
-    return False
-
-
 def from_file(filename, sep='\n'):
     """Parse a file into a list of strings, separated by sep."""
     return open(filename).read().strip().split(sep)
@@ -190,7 +207,12 @@ def solve_all(grids, name='', show_if=0.0):
 def solved(values):
     """A puzzle is solved if each unit is a permutation of the digits 1 to 9."""
 
-    def unit_solved(unit): return set(values[s] for s in unit) == set(digits)
+    def unit_solved(unit):
+        # OR together the bit of each square's digit; squares with several digits add nothing
+        m = 0
+        for s in unit:
+            m |= DIGIT_MASK.get(values[s], 0)
+        return m == ALL_DIGITS
 
     return values is not False and all(unit_solved(unit) for unit in unit_list)
 
@@ -200,13 +222,15 @@ def random_puzzle(n=17):
     Note the resulting puzzle is not guaranteed to be solvable, but empirically
     about 99.8% of them are solvable. Some have multiple solutions."""
     values = dict((s, digits) for s in squares)
-    for s in shuffled(squares):
-        if not assign(values, s, random.choice(values[s])):
-            break
-        ds = [values[s] for s in squares if len(values[s]) == 1]
-        if len(ds) >= n and len(set(ds)) >= 8:
-            return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
-    return random_puzzle(n)  # Give up and make a new puzzle
+    trail = []
+    while True:
+        for s in shuffled(squares):
+            if not assign(values, s, random.choice(values[s]), trail):
+                break
+            ds = [values[s] for s in squares if len(values[s]) == 1]
+            if len(ds) >= n and len(set(ds)) >= 8:
+                return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
+        undo(values, trail, 0)  # Give up and make a new puzzle on the emptied grid
 
 
 grid1 = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'